@@ -0,0 +1,170 @@
+"""
+Benchmark for FORWARD-chain traversal cost in vpcctl
+
+Builds N VPCs with public subnets, peers the last two and pushes iperf3
+traffic between them, once through vpcctl's ipset dispatch chain and once
+through the old flat layout (every subnet rule appended to FORWARD). For
+each run the iptables counters are zeroed beforehand and the rules each
+packet walked are reconstructed from the per-rule packet hits afterwards.
+Requires root, ipset and iperf3.
+"""
+import json
+import subprocess
+import sys
+import time
+
+import click
+
+TERMINAL = {"ACCEPT", "DROP", "REJECT"}
+
+
+def vpcctl(*args):
+    subprocess.run([sys.executable, "vpcctl.py", *args], check=True, capture_output=True)
+
+
+def iptables(*args, check=True):
+    subprocess.run(["iptables", *args], check=check, capture_output=True)
+
+
+def read_counters():
+    """
+    Parses `iptables -L -v -x -n` into {chain: (policy_pkts, [(target, pkts), ...])}
+    """
+    output = subprocess.check_output(["iptables", "-L", "-v", "-x", "-n"], text=True)
+    chains = {}
+    rules = None
+    for line in output.splitlines():
+        parts = line.split()
+        if not parts or parts[0] == "pkts":
+            continue
+        if parts[0] == "Chain":
+            policy = int(parts[4]) if parts[2] == "(policy" else 0
+            rules = []
+            chains[parts[1]] = (policy, rules)
+        else:
+            rules.append((parts[2], int(parts[0])))
+    return chains
+
+
+def terminated(chains, chain):
+    """
+    Packets that ended in an ACCEPT/DROP/REJECT inside `chain` or its sub-chains
+    """
+    total = 0
+    for target, pkts in chains[chain][1]:
+        if target in TERMINAL:
+            total += pkts
+        elif target in chains:
+            total += terminated(chains, target)
+    return total
+
+
+def walk(chains, chain, entering):
+    """
+    Returns (rule evaluations, packets returning) for `entering` packets
+    walking `chain`, following jumps into user chains
+    """
+    walked = 0
+    remaining = entering
+    for target, pkts in chains[chain][1]:
+        walked += remaining
+        if target in TERMINAL:
+            remaining -= pkts
+        elif target in chains:
+            sub_walked, returned = walk(chains, target, pkts)
+            walked += sub_walked
+            remaining -= pkts - returned
+    return walked, remaining
+
+
+def rules_per_packet():
+    chains = read_counters()
+    entering = chains["FORWARD"][0] + terminated(chains, "FORWARD")
+    if not entering:
+        return 0.0
+    walked, _ = walk(chains, "FORWARD", entering)
+    return walked / entering
+
+
+def measure_throughput(server_ns, server_ip, client_ns, seconds):
+    server = subprocess.Popen(["ip", "netns", "exec", server_ns, "iperf3", "-s", "-1", "-B", server_ip],
+                              stdout=subprocess.DEVNULL)
+    time.sleep(0.5)
+    try:
+        result = subprocess.run(
+            ["ip", "netns", "exec", client_ns, "iperf3", "-c", server_ip, "-t", str(seconds), "-J"],
+            capture_output=True, text=True, check=True
+        )
+    finally:
+        server.terminate()
+        server.wait()
+    return json.loads(result.stdout)["end"]["sum_received"]["bits_per_second"]
+
+
+def flat_rules(names, cidrs):
+    """
+    The per-subnet FORWARD rules vpcctl appended before dispatch via ipsets
+    """
+    rules = []
+    for cidr in cidrs:
+        rules.append(["FORWARD", "-s", cidr, "-j", "ACCEPT"])
+        rules.append(["FORWARD", "-d", cidr, "-m", "state", "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"])
+    a, b = names[-2], names[-1]
+    rules.append(["FORWARD", "-i", f"br-{a}", "-o", f"br-{b}", "-j", "ACCEPT"])
+    rules.append(["FORWARD", "-i", f"br-{b}", "-o", f"br-{a}", "-j", "ACCEPT"])
+    return rules
+
+
+def run(server_ns, server_ip, client_ns, seconds):
+    iptables("-Z")
+    bps = measure_throughput(server_ns, server_ip, client_ns, seconds)
+    return rules_per_packet(), bps
+
+
+@click.command()
+@click.option("--vpcs", default="2,10,50,100", help="Comma separated VPC counts to test (at least 2).")
+@click.option("--subnets", default=4, help="Subnets per VPC (at most 15).")
+@click.option("--seconds", default=5, help="iperf3 duration per measurement.")
+def bench(vpcs, subnets, seconds):
+    """Reports rules walked per packet and throughput for both layouts as the VPC count grows."""
+    counts = [int(n) for n in vpcs.split(",")]
+
+    click.echo(f"{'vpcs':>6} {'flat rules/pkt':>15} {'flat Mbit/s':>12} {'ipset rules/pkt':>16} {'ipset Mbit/s':>13}")
+    for n in counts:
+        names = [f"b{i}" for i in range(n)]
+        cidrs = []
+        try:
+            for i, vpc in enumerate(names):
+                vpcctl("create-vpc", vpc, f"10.{i // 250 + 100}.{i % 250}.1/24")
+                for s in range(subnets):
+                    cidr = f"10.{i // 250 + 100}.{i % 250}.{s * 16 + 16}/28"
+                    vpcctl("add-subnet", vpc, f"{vpc}s{s}", cidr, "--type", "public")
+                    cidrs.append(cidr)
+            vpcctl("peer-vpcs", names[-2], names[-1])
+
+            # the server sits in the last subnet added, the worst case for the flat layout
+            server_ns = f"{names[-1]}s{subnets - 1}"
+            server_ip = f"10.{(n - 1) // 250 + 100}.{(n - 1) % 250}.{subnets * 16 + 1}"
+            client_ns = f"{names[-2]}s0"
+
+            ipset_walked, ipset_bps = run(server_ns, server_ip, client_ns, seconds)
+
+            iptables("-D", "FORWARD", "-j", "VPCCTL-FWD")
+            rules = flat_rules(names, cidrs)
+            try:
+                for rule in rules:
+                    iptables("-A", *rule)
+                flat_walked, flat_bps = run(server_ns, server_ip, client_ns, seconds)
+            finally:
+                for rule in rules:
+                    iptables("-D", *rule, check=False)
+                iptables("-A", "FORWARD", "-j", "VPCCTL-FWD")
+
+            click.echo(f"{n:>6} {flat_walked:>15.1f} {flat_bps / 1e6:>12.1f} {ipset_walked:>16.1f} {ipset_bps / 1e6:>13.1f}")
+        finally:
+            for vpc in names:
+                subprocess.run([sys.executable, "vpcctl.py", "delete-vpc", vpc], capture_output=True)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,131 @@
+"""
+Validation benchmark for firewall rate limits
+
+Applies a firewall policy with vpcctl, then drives local traffic at the
+subnet and checks the measured rates against the policy: iperf3 for the
+tc ingress/egress limits and a burst of TCP connects for each rule's
+conn_rate. Requires root and iperf3; tcp/5201 is opened in the subnet
+only while iperf3 runs.
+"""
+import json
+import socket
+import subprocess
+import sys
+import time
+
+import click
+
+from utils import get_namespace_by_subnet
+
+# longest suffix first so "kbps" is not read as "bps"
+UNITS = {"kbit": 1e3, "mbit": 1e6, "gbit": 1e9, "kbps": 8e3, "mbps": 8e6, "gbps": 8e9, "bit": 1, "bps": 8}
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_rate(rate):
+    """
+    Converts a tc rate such as '20mbit' to bits per second
+    """
+    rate = rate.lower()
+    for unit, scale in UNITS.items():
+        if rate.endswith(unit):
+            return float(rate[:-len(unit)]) * scale
+    return float(rate)
+
+
+def subnet_ip(namespace):
+    output = subprocess.check_output(["ip", "netns", "exec", namespace, "ip", "-4", "addr", "show"], text=True)
+    for line in output.splitlines():
+        if "inet " in line and " lo" not in line:
+            return line.split()[1].split("/")[0]
+    raise RuntimeError(f"No valid IP found for namespace {namespace}")
+
+
+def measure_throughput(namespace, ip, reverse, seconds):
+    # let iperf3 through the policy for the duration of the measurement
+    iperf_rule = ["INPUT", "-p", "tcp", "--dport", "5201", "-j", "ACCEPT"]
+    subprocess.run(["ip", "netns", "exec", namespace, "iptables", "-I", *iperf_rule], check=True)
+    server = subprocess.Popen(["ip", "netns", "exec", namespace, "iperf3", "-s", "-1", "-B", ip],
+                              stdout=subprocess.DEVNULL)
+    time.sleep(0.5)
+    try:
+        cmd = ["iperf3", "-c", ip, "-t", str(seconds), "-J"] + (["-R"] if reverse else [])
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    finally:
+        server.terminate()
+        server.wait()
+        subprocess.run(["ip", "netns", "exec", namespace, "iptables", "-D", *iperf_rule], check=False)
+    return json.loads(result.stdout)["end"]["sum_received"]["bits_per_second"]
+
+
+def measure_connect_rate(ip, port, seconds):
+    """
+    Opens connections as fast as possible and returns accepted connects/s
+    """
+    accepted = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((ip, port), timeout=0.2):
+                accepted += 1
+        except OSError:
+            pass
+    return accepted / seconds
+
+
+def report(name, measured, limit, tolerance):
+    ok = measured <= limit * (1 + tolerance)
+    click.echo(f"{'PASS' if ok else 'FAIL'} {name}: measured {measured:.1f}, limit {limit:.1f}")
+    return ok
+
+
+@click.command()
+@click.argument("filename", required=True)
+@click.option("--seconds", default=5, help="Duration of each measurement.")
+@click.option("--tolerance", default=0.1, help="Allowed overshoot as a fraction of the limit.")
+def bench(filename, seconds, tolerance):
+    """Checks that the limits in FILENAME hold under local load."""
+    subprocess.run([sys.executable, "vpcctl.py", "apply-firewall", filename], check=True)
+
+    with open(filename, "r", encoding="utf-8") as f:
+        policies = json.load(f)
+    policies = policies if isinstance(policies, list) else [policies]
+
+    ok = True
+    for policy in policies:
+        namespace = get_namespace_by_subnet(policy.get("subnet"))
+        if not namespace:
+            click.echo(f"SKIP no namespace for subnet {policy.get('subnet')}")
+            continue
+        ip = subnet_ip(namespace)
+        rate_limit = policy.get("rate_limit", {})
+
+        for direction, reverse in (("ingress", False), ("egress", True)):
+            if rate_limit.get(direction):
+                bps = measure_throughput(namespace, ip, reverse, seconds)
+                ok &= report(f"{namespace} {direction} Mbit/s", bps / 1e6,
+                             parse_rate(rate_limit[direction]) / 1e6, tolerance)
+
+        for rule in policy.get("ingress", []):
+            if not rule.get("conn_rate") or rule["protocol"] != "tcp":
+                continue
+            server = subprocess.Popen(
+                ["ip", "netns", "exec", namespace, "python3", "-m", "http.server", str(rule["port"]), "--bind", ip],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            time.sleep(0.5)
+            try:
+                rate = measure_connect_rate(ip, rule["port"], seconds)
+            finally:
+                server.terminate()
+                server.wait()
+            # The burst is spent once at the start of the run
+            count, period = rule["conn_rate"].split("/")
+            limit = float(count) / PERIODS[period] + rule.get("conn_burst", 5) / seconds
+            ok &= report(f"{namespace} tcp/{rule['port']} conn/s", rate, limit, tolerance)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,163 @@
+"""
+Transaction journal for vpcctl
+
+Multi-step commands plan their `ip`/`iptables` calls as a list of steps,
+each with an optional undo command, and apply them as one batch. Progress
+is written to a journal file so a failure (or a crash) can be rolled back
+in reverse order instead of leaving half-built namespaces, veths, routes
+and iptables rules behind.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import subprocess
+
+JOURNAL_PATH = os.getenv("VPCCTL_JOURNAL", "/var/lib/vpcctl/journal.json")
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def journal_lock(path=JOURNAL_PATH, blocking=True):
+    """
+    Holds an exclusive flock next to the journal. Yields False when
+    blocking is off and another vpcctl run already holds it.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class Transaction:
+    """
+    A batch of planned steps that is applied all-or-nothing
+    """
+
+    def __init__(self, name, path=JOURNAL_PATH):
+        self.name = name
+        self.path = path
+        self.steps = []
+
+    def step(self, cmd, undo=None, check=True, msg=None):
+        """
+        Plans a command. `undo` is run (best-effort) on rollback once `cmd`
+        has started, since a crash mid-command leaves its effect unknown.
+        Steps with check=False never abort the batch.
+        """
+        self.steps.append({
+            "cmd": cmd,
+            "undo": undo,
+            "check": check,
+            "msg": msg,
+            "state": "planned",  # planned -> started -> applied, or failed
+        })
+
+    def apply(self, prepare=None):
+        """
+        Runs every planned step in order, rolling back the applied ones
+        in reverse if any checked step fails.
+
+        `prepare(tx)` plans steps that depend on shared host state. It is
+        called under the journal lock, so its checks cannot race another
+        run, and the steps it plans run before the others.
+        """
+        # Concurrent runs queue up here instead of sharing the journal
+        with journal_lock(self.path):
+            # A journal still on disk was left by a run that died before we got the lock
+            _recover_locked(self.path)
+            if prepare is not None:
+                planned, self.steps = self.steps, []
+                prepare(self)
+                self.steps.extend(planned)
+            self._write()
+            try:
+                for step in self.steps:
+                    if step["msg"]:
+                        logger.info(step["msg"])
+                    # recorded before running so a crash mid-command still gets undone
+                    step["state"] = "started"
+                    self._write()
+                    try:
+                        subprocess.run(step["cmd"], check=step["check"])
+                    except (subprocess.CalledProcessError, OSError):
+                        # a command that reported failure did not take effect; undoing
+                        # it could remove something that existed before this run
+                        step["state"] = "failed"
+                        raise
+                    step["state"] = "applied"
+                    self._write()
+            except (subprocess.CalledProcessError, OSError) as e:
+                logger.error(f"Step failed in '{self.name}': {e}")
+                rollback(self.steps)
+                self._clear()
+                raise
+            self._clear()
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"name": self.name, "steps": self.steps}, f)
+        os.replace(tmp_path, self.path)
+
+    def _clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def rollback(steps):
+    """
+    Undoes started and applied steps in reverse order. Undo commands are
+    best-effort: a resource that is already gone must not stop the rest of
+    the rollback.
+    """
+    for step in reversed(steps):
+        if step["state"] not in ("started", "applied") or not step["undo"]:
+            continue
+        logger.info(f"Rolling back: {' '.join(step['undo'])}")
+        subprocess.run(step["undo"], check=False, capture_output=True)
+
+
+def recover_journal(path=JOURNAL_PATH):
+    """
+    Rolls back a transaction left behind by an interrupted run. A journal
+    whose lock is still held belongs to a live run and is left alone.
+    """
+    if not os.path.exists(path):
+        return
+
+    with journal_lock(path, blocking=False) as locked:
+        if not locked:
+            logger.info("Another vpcctl operation is in progress, skipping journal recovery")
+            return
+        _recover_locked(path)
+
+
+def _recover_locked(path):
+    if not os.path.exists(path):
+        return
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            journal = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Discarding unreadable journal {path}: {e}")
+        os.remove(path)
+        return
+
+    logger.warning(f"Recovering interrupted operation '{journal.get('name')}'")
+    rollback(journal.get("steps", []))
+    os.remove(path)
+    logger.info("Recovery complete")
@@ -0,0 +1,151 @@
+import importlib
+import os
+
+import pytest
+
+pytest.importorskip("requests")
+
+LOGS = os.path.join(os.path.dirname(__file__), "..", "nginx", "logs")
+ACCESS_LOG = os.path.join(LOGS, "access.log")
+ERROR_LOG = os.path.join(LOGS, "error.log")
+
+
+@pytest.fixture
+def watcher(monkeypatch):
+    monkeypatch.setenv("SLACK_WEBHOOK_URL", "")
+    monkeypatch.setenv("ALERT_COOLDOWN_SEC", "300")
+    monkeypatch.setenv("MAINTENANCE_MODE", "false")
+    import watcher as module
+    # reload for fresh windows, cooldowns and detector registry
+    module = importlib.reload(module)
+    alerts = []
+    monkeypatch.setattr(module, "send_slack", lambda title, text, color="": alerts.append((title, text)))
+    module.alerts = alerts
+    return module
+
+
+def access_line(ts, status, pool, release="R1", upstream_status=None):
+    upstream_status = upstream_status or str(status)
+    return (
+        f'192.168.65.1 - - [01/Nov/2025:20:{ts // 60:02d}:{ts % 60:02d} +0000] "GET /version HTTP/1.1" '
+        f'status={status} bytes=57 pool={pool} release={release} upstream_status={upstream_status} '
+        f'upstream_addr=172.21.0.2:3000 req_time=0.010 upstream_rt=0.010 ua="curl/8.7.1"'
+    )
+
+
+def titles(watcher, prefix):
+    return [title for title, _ in watcher.alerts if title.startswith(prefix)]
+
+
+def test_replay_reports_expected_failovers(watcher):
+    watcher.replay(ACCESS_LOG, ERROR_LOG)
+
+    failovers = titles(watcher, "🔄")
+    assert failovers.count("🔄 Failover detected: blue → green") == 7
+    assert failovers.count("🔄 Failover detected: green → blue") == 6
+    assert len(failovers) == 13
+
+
+def test_replay_flags_green_only(watcher):
+    watcher.replay(ACCESS_LOG, ERROR_LOG)
+
+    error_alerts = titles(watcher, "🚨")
+    assert len(error_alerts) == 4
+    assert all(title.startswith("🚨 High upstream 5xx rate on green:") for title in error_alerts)
+    assert all("Release: RELEASE_ID_GREEN" in text for title, text in watcher.alerts if title.startswith("🚨"))
+    assert ("-", "-") not in watcher.stats
+    blue = watcher.stats[("blue", "RELEASE_ID_BLUE")]
+    assert blue.rate < blue.threshold
+
+
+def test_no_upstream_errors_count_against_serving_pool(watcher):
+    watcher.process_log_line(access_line(0, 200, "green"))
+    for ts in range(1, 30):
+        watcher.process_log_line(access_line(ts, 502, "-", release="-", upstream_status="-"))
+
+    assert list(watcher.stats) == [("green", "R1")]
+    assert watcher.stats[("green", "R1")].errors == 29
+    assert titles(watcher, "🔄") == []
+    assert len(titles(watcher, "🚨 High upstream 5xx rate on green")) == 1
+
+
+def test_cooldown_follows_log_time(watcher):
+    # flips 10s apart share one cooldown; the flip 10 minutes later does not
+    for ts, pool in ((0, "blue"), (10, "green"), (20, "blue"), (30, "green")):
+        watcher.process_log_line(access_line(ts, 200, pool))
+    assert titles(watcher, "🔄") == ["🔄 Failover detected: blue → green", "🔄 Failover detected: green → blue"]
+
+    watcher.process_log_line(access_line(640, 200, "blue"))
+    watcher.process_log_line(access_line(641, 200, "green"))
+    assert len(titles(watcher, "🔄")) == 4
+    assert "Time: 2025-11-01T20:10:41Z" in watcher.alerts[-1][1]
+
+
+def test_min_samples_guard(watcher):
+    for ts in range(watcher.MIN_SAMPLES - 1):
+        watcher.process_log_line(access_line(ts, 500, "blue"))
+    assert titles(watcher, "🚨") == []
+
+    watcher.process_log_line(access_line(watcher.MIN_SAMPLES, 500, "blue"))
+    assert len(titles(watcher, "🚨")) == 1
+
+
+def test_window_stats_evicts_in_place(watcher):
+    stats = watcher.WindowStats(3)
+    for status in (500, 500, 200, 200):
+        stats.add(status)
+    assert (stats.errors, stats.total) == (1, 3)
+
+
+def error_line(ts, conn, kind="upstream timed out (110: Connection timed out) while reading response header"):
+    return (
+        f'2025/11/01 20:{ts // 60:02d}:{ts % 60:02d} [error] 12#12: *{conn} {kind} from upstream, '
+        f'client: 192.168.65.1, server: , request: "GET /version HTTP/1.1", '
+        f'upstream: "http://172.21.0.2:3000/version", host: "localhost:8080"'
+    )
+
+
+def test_replay_attaches_upstream_errors(watcher):
+    watcher.replay(ACCESS_LOG, ERROR_LOG)
+
+    error_alerts = [text for title, text in watcher.alerts if title.startswith("🚨")]
+    assert any("*Upstream errors*" in text and "no live upstreams (backend)" in text for text in error_alerts)
+
+
+def test_parse_error_line(watcher):
+    error = watcher.parse_error_line(error_line(5, 42))
+    assert error["conn"] == "42"
+    assert error["kind"] == "upstream timed out"
+    assert error["upstream"] == "172.21.0.2:3000"
+    assert error["ts"] == 1762027205
+
+
+def test_error_counts_are_not_capped(watcher):
+    for conn in range(500):
+        watcher.process_error_line(error_line(0, conn))
+    counts = watcher.upstream_errors.around(1762027200, 1)
+    assert counts == {("upstream timed out", "172.21.0.2:3000"): 500}
+    assert "×500" in watcher.correlated_errors(watcher.parse_log_line(access_line(1, 504, "blue")))
+
+
+def test_error_buffer_evicts_past_horizon(watcher):
+    buffer = watcher.ErrorBuffer(horizon=10)
+    buffer.add(0, {"kind": "a", "upstream": None})
+    buffer.add(11, {"kind": "b", "upstream": None})
+    assert 0 not in buffer.buckets
+    assert buffer.around(11, 11) == {("b", "-"): 1}
+
+
+def test_error_log_timezone_is_configurable(watcher, monkeypatch):
+    monkeypatch.setenv("ERROR_LOG_TZ", "+0100")
+    module = importlib.reload(watcher)
+    assert module.parse_error_line(error_line(5, 1))["ts"] == 1762027205 - 3600
+
+
+def test_lines_without_upstream_are_not_buffered(watcher):
+    watcher.process_error_line("2025/11/01 20:00:00 [notice] 1#1: signal process started")
+    watcher.process_error_line("2025/11/01 20:00:00 [notice] 1#1: start worker process 29")
+    watcher.process_error_line('2025/11/01 20:00:00 [warn] 1#1: conflicting server name "localhost" on 0.0.0.0:8080, ignored')
+    watcher.process_error_line(error_line(0, 1))
+
+    assert watcher.upstream_errors.around(1762027200, 1) == {("upstream timed out", "172.21.0.2:3000"): 1}
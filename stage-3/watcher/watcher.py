@@ -3,43 +3,139 @@
 Simple Nginx log watcher:
 - tails /var/log/nginx/access.log
 - parses pool, release, status, upstream_status
-- detects pool flips and elevated 5xx error rates
+- detects pool flips and elevated 5xx error rates per pool/release,
+  against an EWMA baseline (detectors are pluggable via @detector)
+- tails /var/log/nginx/error.log and attaches the upstream errors logged
+  around an alerting request to the alert
+- `watcher.py --replay <access.log> [error.log]` runs recorded logs through the detectors
 - posts to Slack webhook provided via SLACK_WEBHOOK_URL
 """
 
 import os
 import re
+import sys
 import time
 import json
+import heapq
 import queue
 import threading
 from collections import deque
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 import requests
 
 LOG_PATH = "/var/log/nginx/access.log"
+ERROR_LOG_PATH = "/var/log/nginx/error.log"
 SLACK_WEBHOOK = os.getenv("SLACK_WEBHOOK_URL", "").strip()
 ERROR_RATE_THRESHOLD = float(os.getenv("ERROR_RATE_THRESHOLD", "2"))  # percent
 WINDOW_SIZE = int(os.getenv("WINDOW_SIZE", "200"))
 ALERT_COOLDOWN_SEC = int(os.getenv("ALERT_COOLDOWN_SEC", "300"))
 MAINTENANCE_MODE = os.getenv("MAINTENANCE_MODE", "false").lower() == "true"
+MIN_SAMPLES = int(os.getenv("MIN_SAMPLES", "20"))
+EWMA_ALPHA = float(os.getenv("EWMA_ALPHA", "0.02"))
+EWMA_FACTOR = float(os.getenv("EWMA_FACTOR", "3"))
+ERROR_BUFFER_SEC = int(os.getenv("ERROR_BUFFER_SEC", "300"))
+CORRELATE_WINDOW_SEC = int(os.getenv("CORRELATE_WINDOW_SEC", "10"))
+ERROR_LOG_TZ = datetime.strptime(os.getenv("ERROR_LOG_TZ", "+0000"), "%z").tzinfo  # e.g. +0100 or -05:00
 
 # regex to extract fields created by nginx log_format stage_watch
+# upstream_status/upstream_addr/upstream_rt hold a comma separated list when nginx retried
 LOG_RE = re.compile(
-    r'.*status=(?P<status>\d+).*pool=(?P<pool>[^ ]+)\s+release=(?P<release>[^ ]+)\s+upstream_status=(?P<upstream_status>[^ ]+)\s+upstream_addr=(?P<upstream_addr>[^ ]+)\s+req_time=(?P<req_time>[^ ]+)\s+upstream_rt=(?P<upstream_rt>[^ ]+).*'
+    r'.*status=(?P<status>\d+).*pool=(?P<pool>[^ ]+)\s+release=(?P<release>[^ ]+)\s+upstream_status=(?P<upstream_status>.+?)\s+upstream_addr=(?P<upstream_addr>.+?)\s+req_time=(?P<req_time>[^ ]+)\s+upstream_rt=(?P<upstream_rt>.+?)\s+ua=.*'
 )
 
-# rolling window for status codes (store ints)
-window = deque(maxlen=WINDOW_SIZE)
+TIME_RE = re.compile(r'\[(?P<time_local>\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4})\]')
+
+# nginx error log: "2025/11/01 20:57:37 [error] 12#12: *1 upstream timed out (110: ...) while ..., upstream: "http://..."
+ERROR_RE = re.compile(
+    r'(?P<time>\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}) \[(?P<level>\w+)\] \d+#\d+: (?:\*(?P<conn>\d+) )?(?P<message>[^,]*)(?:.*upstream: "(?P<upstream>[^"]*)")?'
+)
+
+
+class ErrorBuffer:
+    """
+    Bounded ring of upstream error counts bucketed by epoch second, so an
+    access-log event can be joined with the errors around it in O(1)
+    """
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self.buckets = {}  # epoch second -> {(kind, upstream): count}
+        self.order = deque()  # bucket seconds, oldest first
+
+    def add(self, ts, error):
+        bucket = self.buckets.get(ts)
+        if bucket is None:
+            bucket = self.buckets[ts] = {}
+            self.order.append(ts)
+        key = (error["kind"], error["upstream"] or "-")
+        bucket[key] = bucket.get(key, 0) + 1
+        while self.order and self.order[0] < ts - self.horizon:
+            self.buckets.pop(self.order.popleft(), None)
+
+    def around(self, ts, span):
+        counts = {}
+        for second in range(ts - span, ts + 1):
+            for key, n in self.buckets.get(second, {}).items():
+                counts[key] = counts.get(key, 0) + n
+        return counts
+
+
+class WindowStats:
+    """
+    Rolling 5xx statistics for one pool/release, updated in O(1) per request
+    """
+
+    def __init__(self, size):
+        self.window = deque(maxlen=size)
+        self.errors = 0
+        self.baseline = 0.0  # EWMA of the error rate (percent) while healthy
+
+    def add(self, status):
+        is_error = 500 <= status <= 599
+        if len(self.window) == self.window.maxlen:
+            self.errors -= self.window[0]
+        self.window.append(is_error)
+        self.errors += is_error
+
+        # the baseline only learns from healthy periods so an outage cannot raise its own threshold
+        if self.rate < self.threshold:
+            self.baseline += EWMA_ALPHA * (self.rate - self.baseline)
+
+    @property
+    def total(self):
+        return len(self.window)
+
+    @property
+    def rate(self):
+        return (self.errors / self.total) * 100.0
+
+    @property
+    def threshold(self):
+        return max(ERROR_RATE_THRESHOLD, EWMA_FACTOR * self.baseline)
+
+
+# per pool/release rolling windows: (pool, release) -> WindowStats
+stats = {}
+upstream_errors = ErrorBuffer(ERROR_BUFFER_SEC)
 last_pool = None
 last_release = None  # Track previous release
 last_alert = {}  # alert_type -> timestamp
 
+# detectors are called as detector(event, window_stats) and return
+# (alert_key, title, text, color) or None; register new ones with @detector
+DETECTORS = []
+
+
+def detector(fn):
+    DETECTORS.append(fn)
+    return fn
+
 
 def send_slack(title: str, text: str, color: str = "#d93025"):
     if not SLACK_WEBHOOK:
         print("[watcher] SLACK_WEBHOOK_URL not set, skipping alert:", title)
+        print(text)
         return
     payload = {
         "attachments": [
@@ -60,8 +156,9 @@ def send_slack(title: str, text: str, color: str = "#d93025"):
         print("[watcher] Slack send failed:", e)
 
 
-def cooldown_allows(alert_key: str):
-    now = time.time()
+def cooldown_allows(alert_key: str, now=None):
+    # cooldowns run on the log's clock when known, so a replay behaves like the live run
+    now = time.time() if now is None else now
     last = last_alert.get(alert_key)
     if last and (now - last) < ALERT_COOLDOWN_SEC:
         return False
@@ -69,70 +166,149 @@ def cooldown_allows(alert_key: str):
     return True
 
 
-def process_log_line(line: str):
-    global last_pool, last_release
+def event_time(event):
+    if event.get("ts") is None:
+        return f"{datetime.utcnow().isoformat()}Z"
+    return datetime.fromtimestamp(event["ts"], timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_log_line(line: str):
     m = LOG_RE.match(line)
     if not m:
-        return
+        return None
 
+    event = m.groupdict()
     try:
-        status = int(m.group("status"))
+        event["status"] = int(event["status"])
     except Exception:
-        status = 0
-    pool = m.group("pool")
-    release = m.group("release")
-    upstream_status = m.group("upstream_status")
-    upstream_addr = m.group("upstream_addr")
-    req_time = m.group("req_time")
-    upstream_rt = m.group("upstream_rt")
-
-    # rolling window update
-    window.append(status)
-
-    # failover detection: pool changed
-    if last_pool is None:
-        last_pool = pool
-        last_release = release
-    elif pool != last_pool:
-        if not MAINTENANCE_MODE and cooldown_allows(f"failover:{last_pool}->{pool}"):
-            title = f"🔄 Failover detected: {last_pool} → {pool}"
-            # Show release transition: old -> new
-            release_transition = f"{last_release} → {release}" if last_release else release
-            text = (
-                f"*Release (from→to)*: {release_transition}\n"
-                f"*Upstream*: {upstream_addr}\n"
-                f"*Upstream_status*: {upstream_status}\n"
-                f"*Req_time*: {req_time}s\n"
-                f"Time: {datetime.utcnow().isoformat()}Z"
-            )
-            send_slack(title, text, color="#ff9900")
-        last_pool = pool
-        last_release = release
-    else:
-        # Update release even if pool hasn't changed (for rolling updates within same pool)
-        last_release = release
-
-    # error-rate detection
-    total = len(window)
-    if total >= 10:  # only evaluate when some data exists
-        errors = sum(1 for s in window if 500 <= s <= 599)
-        error_rate = (errors / total) * 100.0
-        if error_rate >= ERROR_RATE_THRESHOLD and not MAINTENANCE_MODE:
-            if cooldown_allows("error_rate"):
-                title = f"🚨 High upstream 5xx rate: {error_rate:.2f}% over last {total} reqs"
-                text = (
-                    f"Errors: {errors} of {total}\n"
-                    f"Threshold: {ERROR_RATE_THRESHOLD}%\n"
-                    f"Latest upstream: {upstream_addr}\n"
-                    f"Latest pool: {pool}\n"
-                    f"Latest release: {release}\n"
-                    f"Time: {datetime.utcnow().isoformat()}Z"
-                )
-                send_slack(title, text, color="#d93025")
-
-
-def tail_log(path, q: queue.Queue):
+        event["status"] = 0
+    t = TIME_RE.search(line)
+    event["ts"] = int(datetime.strptime(t.group("time_local"), "%d/%b/%Y:%H:%M:%S %z").timestamp()) if t else None
+    return event
+
+
+def parse_error_line(line: str):
+    m = ERROR_RE.match(line)
+    if not m:
+        return None
+
+    error = m.groupdict()
+    # nginx writes error.log in its local time, without an offset
+    error["ts"] = int(datetime.strptime(error["time"], "%Y/%m/%d %H:%M:%S").replace(tzinfo=ERROR_LOG_TZ).timestamp())
+    # "upstream timed out (110: Connection timed out) while reading ..." -> "upstream timed out"
+    error["kind"] = re.split(r" \(| while ", error["message"], maxsplit=1)[0]
+    if error["upstream"]:
+        error["upstream"] = error["upstream"].split("://", 1)[-1].split("/", 1)[0]
+    return error
+
+
+def process_error_line(line: str):
+    error = parse_error_line(line)
+    # only upstream failures explain 5xx/retries; worker notices, reloads and
+    # other lines without an upstream stay out of the alerts
+    if error is not None and error["upstream"]:
+        upstream_errors.add(error["ts"], error)
+
+
+def correlated_errors(event):
+    """
+    Summarises upstream errors logged while the request was in flight
+    """
+    if event["ts"] is None:
+        return ""
+    try:
+        span = min(int(float(event["req_time"])) + 1, CORRELATE_WINDOW_SEC)
+    except ValueError:
+        span = CORRELATE_WINDOW_SEC
+    counts = upstream_errors.around(event["ts"], span)
+    if not counts:
+        return ""
+
+    lines = [f"• {kind} ({upstream}) ×{n}" for (kind, upstream), n in sorted(counts.items(), key=lambda kv: -kv[1])[:5]]
+    return "\n*Upstream errors*:\n" + "\n".join(lines)
+
+
+@detector
+def detect_failover(event, window_stats):
+    global last_pool, last_release
+    pool = event["pool"]
+    release = event["release"]
+
+    alert = None
+    if last_pool is not None and pool != last_pool:
+        title = f"🔄 Failover detected: {last_pool} → {pool}"
+        # Show release transition: old -> new
+        release_transition = f"{last_release} → {release}" if last_release else release
+        text = (
+            f"*Release (from→to)*: {release_transition}\n"
+            f"*Upstream*: {event['upstream_addr']}\n"
+            f"*Upstream_status*: {event['upstream_status']}\n"
+            f"*Req_time*: {event['req_time']}s\n"
+            f"Time: {event_time(event)}"
+        )
+        alert = (f"failover:{last_pool}->{pool}", title, text, "#ff9900")
+
+    # Update release even if pool hasn't changed (for rolling updates within same pool)
+    last_pool = pool
+    last_release = release
+    return alert
+
+
+@detector
+def detect_error_rate(event, window_stats):
+    # only evaluate once the pool/release has enough samples to not flap
+    if window_stats.total < MIN_SAMPLES:
+        return None
+
+    error_rate = window_stats.rate
+    threshold = window_stats.threshold
+    if error_rate < threshold:
+        return None
+
+    total = window_stats.total
+    title = f"🚨 High upstream 5xx rate on {event['pool']}: {error_rate:.2f}% over last {total} reqs"
+    text = (
+        f"Errors: {window_stats.errors} of {total}\n"
+        f"Threshold: {threshold:.2f}% (baseline {window_stats.baseline:.2f}%)\n"
+        f"Latest upstream: {event['upstream_addr']}\n"
+        f"Pool: {event['pool']}\n"
+        f"Release: {event['release']}\n"
+        f"Time: {event_time(event)}"
+    )
+    return (f"error_rate:{event['pool']}:{event['release']}", title, text, "#d93025")
+
+
+def process_log_line(line: str):
+    event = parse_log_line(line)
+    if event is None:
+        return
+
+    # pool "-" means no upstream answered at all; charge those errors to the
+    # pool that was serving instead of treating "-" as a pool of its own
+    if event["pool"] == "-":
+        if last_pool is None:
+            return
+        event["pool"], event["release"] = last_pool, last_release
+
+    key = (event["pool"], event["release"])
+    window_stats = stats.get(key)
+    if window_stats is None:
+        window_stats = stats[key] = WindowStats(WINDOW_SIZE)
+    window_stats.add(event["status"])
+
+    for detect in DETECTORS:
+        alert = detect(event, window_stats)
+        if alert is None or MAINTENANCE_MODE:
+            continue
+        alert_key, title, text, color = alert
+        if cooldown_allows(alert_key, event["ts"]):
+            send_slack(title, text + correlated_errors(event), color=color)
+
+
+def tail_log(path, q: queue.Queue, source="access"):
     # follow file; handle rotation by re-opening if inode changes
+    while not os.path.exists(path):
+        time.sleep(1)
     with open(path, "r") as f:
         # seek to end
         f.seek(0, 2)
@@ -140,7 +316,7 @@ def tail_log(path, q: queue.Queue):
         while True:
             line = f.readline()
             if line:
-                q.put(line)
+                q.put((source, line))
             else:
                 time.sleep(0.1)
                 # check rotation
@@ -152,20 +328,51 @@ def tail_log(path, q: queue.Queue):
                     time.sleep(0.5)
 
 
+HANDLERS = {"access": process_log_line, "error": process_error_line}
+
+
+def replay(path, error_path=None):
+    # run recorded logs through the detectors in time order; alerts are printed, never posted
+    global SLACK_WEBHOOK
+    SLACK_WEBHOOK = ""
+
+    def timed(source, parse, log_path):
+        with open(log_path, "r") as f:
+            for line in f:
+                parsed = parse(line)
+                if parsed is not None and parsed["ts"] is not None:
+                    # errors sort before access lines of the same second
+                    yield parsed["ts"], source == "access", source, line
+
+    streams = [timed("access", parse_log_line, path)]
+    if error_path:
+        streams.append(timed("error", parse_error_line, error_path))
+    for _, _, source, line in heapq.merge(*streams):
+        HANDLERS[source](line)
+
+    for (pool, release), window_stats in sorted(stats.items()):
+        print(f"[watcher] {pool}/{release}: {window_stats.errors} errors in last {window_stats.total} reqs, "
+              f"baseline {window_stats.baseline:.2f}%")
+
+
 def main():
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "--replay":
+        replay(*sys.argv[2:])
+        return
     if not os.path.exists(LOG_PATH):
         print(f"[watcher] log path {LOG_PATH} does not exist yet - waiting...")
         while not os.path.exists(LOG_PATH):
             time.sleep(1)
     q = queue.Queue()
-    t = threading.Thread(target=tail_log, args=(LOG_PATH, q), daemon=True)
-    t.start()
-    print("[watcher] started, monitoring", LOG_PATH)
+    for path, source in ((LOG_PATH, "access"), (ERROR_LOG_PATH, "error")):
+        t = threading.Thread(target=tail_log, args=(path, q, source), daemon=True)
+        t.start()
+    print("[watcher] started, monitoring", LOG_PATH, "and", ERROR_LOG_PATH)
     try:
         while True:
             try:
-                line = q.get(timeout=1)
-                process_log_line(line)
+                source, line = q.get(timeout=1)
+                HANDLERS[source](line)
             except queue.Empty:
                 continue
     except KeyboardInterrupt:
@@ -173,4 +380,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
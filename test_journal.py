@@ -0,0 +1,113 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+import journal
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "journal.json")
+
+
+def write_journal(path, steps):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"name": "interrupted", "steps": steps}, f)
+
+
+def journaled_step(cmd, undo, state):
+    return {"cmd": cmd, "undo": undo, "check": True, "msg": None, "state": state}
+
+
+def test_failed_step_rolls_back_applied_steps(tmp_path, journal_path):
+    marker = str(tmp_path / "marker")
+    tx = journal.Transaction("test", path=journal_path)
+    tx.step(["touch", marker], undo=["rm", marker])
+    tx.step(["false"], undo=["touch", str(tmp_path / "undo-of-failed-step")])
+
+    with pytest.raises(subprocess.CalledProcessError):
+        tx.apply()
+
+    assert not os.path.exists(marker)
+    # the failed step never took effect, so its undo must not run
+    assert not os.path.exists(tmp_path / "undo-of-failed-step")
+    assert not os.path.exists(journal_path)
+
+
+def test_successful_apply_keeps_changes_and_clears_journal(tmp_path, journal_path):
+    marker = str(tmp_path / "marker")
+    tx = journal.Transaction("test", path=journal_path)
+    tx.step(["touch", marker], undo=["rm", marker])
+    tx.apply()
+
+    assert os.path.exists(marker)
+    assert not os.path.exists(journal_path)
+
+
+def test_recover_rolls_back_leftover_journal(tmp_path, journal_path):
+    applied, planned = str(tmp_path / "applied"), str(tmp_path / "planned")
+    open(applied, "w").close()
+    open(planned, "w").close()
+    write_journal(journal_path, [
+        journaled_step(["touch", applied], ["rm", applied], "applied"),
+        journaled_step(["touch", planned], ["rm", planned], "planned"),
+    ])
+
+    journal.recover_journal(journal_path)
+
+    assert not os.path.exists(applied)
+    assert os.path.exists(planned)
+    assert not os.path.exists(journal_path)
+
+
+def test_recover_undoes_step_interrupted_mid_command(tmp_path, journal_path):
+    # the process died after the command ran but before it was marked applied
+    marker = str(tmp_path / "marker")
+    open(marker, "w").close()
+    write_journal(journal_path, [journaled_step(["touch", marker], ["rm", marker], "started")])
+
+    journal.recover_journal(journal_path)
+
+    assert not os.path.exists(marker)
+
+
+def test_recover_skips_journal_of_live_run(tmp_path, journal_path):
+    marker = str(tmp_path / "marker")
+    open(marker, "w").close()
+    write_journal(journal_path, [journaled_step(["touch", marker], ["rm", marker], "applied")])
+
+    with journal.journal_lock(journal_path):
+        journal.recover_journal(journal_path)
+
+    assert os.path.exists(marker)
+    assert os.path.exists(journal_path)
+
+
+def test_apply_recovers_journal_left_by_dead_run(tmp_path, journal_path):
+    stale = str(tmp_path / "stale")
+    open(stale, "w").close()
+    write_journal(journal_path, [journaled_step(["touch", stale], ["rm", stale], "applied")])
+
+    journal.Transaction("test", path=journal_path).apply()
+
+    assert not os.path.exists(stale)
+
+
+def test_prepare_runs_under_lock_and_first(tmp_path, journal_path):
+    order = str(tmp_path / "order")
+    seen = {}
+
+    def prepare(tx):
+        with journal.journal_lock(journal_path, blocking=False) as locked:
+            seen["lock_free"] = locked
+        tx.step(["sh", "-c", f"echo prepared >> {order}"])
+
+    tx = journal.Transaction("test", path=journal_path)
+    tx.step(["sh", "-c", f"echo planned >> {order}"])
+    tx.apply(prepare=prepare)
+
+    assert seen["lock_free"] is False
+    with open(order) as f:
+        assert f.read().split() == ["prepared", "planned"]
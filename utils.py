@@ -57,6 +57,23 @@ def get_subnet_gateway_by_name(subnet_name):
     raise ValueError(f"No valid veth IP found for subnet {subnet_name}")
 
 
+def get_subnet_cidr(subnet_name):
+    """
+    Get the network CIDR of a subnet by its namespace name
+    """
+    result = subprocess.run(
+        ["ip", "netns", "exec", subnet_name, "ip", "-4", "addr", "show"],
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    for line in result.stdout.splitlines():
+        line = line.strip()
+        if line.startswith("inet") and " lo" not in line:
+            return str(ipaddress.ip_network(line.split()[1], strict=False))
+    raise ValueError(f"No valid veth IP found for subnet {subnet_name}")
+
+
 def get_bridge_cidr(bridge_name):
     """
     Get the cidr of a specified bridge name
@@ -121,3 +138,16 @@ def get_bridge_gateway(bridge_name):
         if line.startswith("inet "):
             return line.split()[1].split('/')[0]
     raise RuntimeError(f"No IPv4 address found for {bridge_name}")
+
+
+def chain_exists(chain, table="filter"):
+    """
+    Checks whether an iptables chain exists in the given table
+    """
+    result = subprocess.run(
+        ["iptables", "-t", table, "-S", chain],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    return result.returncode == 0
@@ -7,6 +7,7 @@ import json
 import logging
 import sys
 import ipaddress
+import re
 
 from utils import (
     get_namespace_by_subnet,
@@ -14,8 +15,11 @@ from utils import (
     get_subnet_gateway_by_name,
     get_bridge_cidr,
     get_subnets,
-    get_bridge_gateway
+    get_bridge_gateway,
+    get_subnet_cidr,
+    chain_exists
 )
+from journal import Transaction, recover_journal
 
 # Configure logging
 logging.basicConfig(
@@ -32,7 +36,64 @@ logger = logging.getLogger(__name__)
 def vpcctl():
     """
     """
-    pass
+    recover_journal()
+
+
+# Forwarding policy is a fixed handful of rules that look subnets up in
+# ipsets, so the rules a packet walks do not grow with VPCs or subnets
+DISPATCH_SETS = {
+    "vpcctl-public": "hash:net",           # public subnet CIDRs
+    "vpcctl-public-br": "hash:net,iface",  # public subnet CIDR, its VPC bridge
+    "vpcctl-private": "hash:net,net",      # private subnet CIDR, its VPC network
+    "vpcctl-isolated": "hash:net",         # private subnet CIDRs
+    "vpcctl-peers": "hash:net,net",        # peered VPC networks, both directions
+}
+FORWARD_CHAIN = "VPCCTL-FWD"
+NAT_CHAIN = "VPCCTL-NAT"
+FORWARD_RULES = [
+    # public subnets: anything out, replies back in
+    ["-m", "set", "--match-set", "vpcctl-public", "src", "-j", "ACCEPT"],
+    ["-m", "set", "--match-set", "vpcctl-public", "dst", "-m", "state", "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"],
+    # private subnets: traffic within their own VPC and to peered VPCs, so the
+    # routes peer-vpcs adds in every subnet work; only the internet is blocked
+    ["-m", "set", "--match-set", "vpcctl-private", "src,dst", "-j", "ACCEPT"],
+    ["-m", "set", "--match-set", "vpcctl-private", "dst,src", "-j", "ACCEPT"],
+    ["-m", "set", "--match-set", "vpcctl-peers", "src,dst", "-j", "ACCEPT"],
+    ["-m", "set", "--match-set", "vpcctl-isolated", "src", "-j", "DROP"],
+]
+NAT_RULES = [
+    # MASQUERADE public subnets unless the packet stays on their own bridge
+    ["-m", "set", "--match-set", "vpcctl-public", "src",
+     "-m", "set", "!", "--match-set", "vpcctl-public-br", "src,dst", "-j", "MASQUERADE"],
+]
+
+
+def plan_dispatch_rules(tx):
+    """
+    Plans the shared ipsets and the VPCCTL-FWD/VPCCTL-NAT chains if they are
+    missing. FORWARD and nat POSTROUTING get a single jump each. Passed to
+    Transaction.apply as `prepare` so the chain checks run under the lock.
+
+    Public subnets may reach anything. Private subnets may reach their own
+    VPC and any peered VPC, and everything else from them is dropped.
+    """
+    for set_name, set_type in DISPATCH_SETS.items():
+        tx.step(["ipset", "create", set_name, set_type, "-exist"])
+
+    for table, chain, parent, rules in (("filter", FORWARD_CHAIN, "FORWARD", FORWARD_RULES),
+                                        ("nat", NAT_CHAIN, "POSTROUTING", NAT_RULES)):
+        if chain_exists(chain, table):
+            continue
+        tx.step(["iptables", "-t", table, "-N", chain], undo=["iptables", "-t", table, "-X", chain],
+                msg=f"Creating iptables chain {chain}")
+        for rule in rules:
+            tx.step(["iptables", "-t", table, "-A", chain, *rule], undo=["iptables", "-t", table, "-D", chain, *rule])
+        tx.step(["iptables", "-t", table, "-A", parent, "-j", chain],
+                undo=["iptables", "-t", table, "-D", parent, "-j", chain])
+
+
+def plan_set_member(tx, set_name, member, msg=None):
+    tx.step(["ipset", "add", set_name, member], undo=["ipset", "del", set_name, member], msg=msg)
 
 
 @click.command()
@@ -55,15 +116,21 @@ def create_vpc(name, cidr):
         return
     
     logger.info(f"Creating VPC '{name}' with CIDR {cidr}")
+
+    tx = Transaction(f"create-vpc {name}")
     
-    logger.info(f"Creating bridge interface: {bridge_name}")
-    subprocess.run(["ip", "link", "add", "name", bridge_name, "type", "bridge"], check=True)
+    tx.step(["ip", "link", "add", "name", bridge_name, "type", "bridge"],
+            undo=["ip", "link", "del", bridge_name],
+            msg=f"Creating bridge interface: {bridge_name}")
     
-    logger.info(f"Assigning IP address {cidr} to {bridge_name}")
-    subprocess.run(["ip", "addr", "add", cidr, "dev", bridge_name], check=True)
+    tx.step(["ip", "addr", "add", cidr, "dev", bridge_name],
+            msg=f"Assigning IP address {cidr} to {bridge_name}")
     
-    logger.info(f"Bringing up bridge interface: {bridge_name}")
-    subprocess.run(["ip", "link", "set", bridge_name, "up"], check=True)
+    tx.step(["ip", "link", "set", bridge_name, "up"],
+            msg=f"Bringing up bridge interface: {bridge_name}")
+
+
+    tx.apply(prepare=plan_dispatch_rules)
     
     logger.info(f"VPC '{name}' created successfully with network {cidr}")
     subprocess.run(["ip", "-4", "addr", "show", "dev", bridge_name], check=True)
@@ -100,9 +167,6 @@ def add_subnet(vpc, name, cidr, type):
         return
     
     logger.info(f"Creating {type} subnet '{name}' in VPC '{vpc}' with CIDR {cidr}")
-    
-    logger.info(f"Creating network namespace: {name}")
-    subprocess.run(["ip", "netns", "add", name], check=True)
 
     sub_ip, sub_range = cidr.split("/")
     
@@ -110,60 +174,62 @@ def add_subnet(vpc, name, cidr, type):
     bridge_gateway = get_bridge_gateway(f"br-{vpc}")
     logger.info(f"Using VPC bridge gateway: {bridge_gateway}")
 
-    logger.info(f"Creating veth pair: veth-{name} <-> veth-{name}-br")
-    subprocess.run(["ip", "link", "add", f"veth-{name}", "type", "veth", "peer", "name", f"veth-{name}-br"], check=True)
+    # Assign first available IP from the subnet CIDR to the subnet namespace
+    next_ip = str(list(ipaddress.ip_network(cidr, strict=False).hosts())[0])
+
+    tx = Transaction(f"add-subnet {vpc} {name}")
+
+    tx.step(["ip", "netns", "add", name], undo=["ip", "netns", "del", name],
+            msg=f"Creating network namespace: {name}")
+
+    # Deleting the bridge end removes the whole pair, wherever the peer lives
+    tx.step(["ip", "link", "add", f"veth-{name}", "type", "veth", "peer", "name", f"veth-{name}-br"],
+            undo=["ip", "link", "del", f"veth-{name}-br"],
+            msg=f"Creating veth pair: veth-{name} <-> veth-{name}-br")
     
-    logger.info(f"Attaching veth-{name} to namespace {name}")
-    subprocess.run(["ip", "link", "set", f"veth-{name}", "netns", name], check=True)
+    tx.step(["ip", "link", "set", f"veth-{name}", "netns", name],
+            msg=f"Attaching veth-{name} to namespace {name}")
     
-    logger.info(f"Attaching veth-{name}-br to bridge br-{vpc}")
-    subprocess.run(["ip", "link", "set", f"veth-{name}-br", "master", f"br-{vpc}"], check=True)
+    tx.step(["ip", "link", "set", f"veth-{name}-br", "master", f"br-{vpc}"],
+            msg=f"Attaching veth-{name}-br to bridge br-{vpc}")
     
-    logger.info("Bringing up interfaces")
-    subprocess.run(["ip", "link", "set", f"veth-{name}-br", "up"], check=True)
-    subprocess.run(["ip", "link", "set", f"br-{vpc}", "up"], check=True)
+    tx.step(["ip", "link", "set", f"veth-{name}-br", "up"], msg="Bringing up interfaces")
+    tx.step(["ip", "link", "set", f"br-{vpc}", "up"])
     
-    # Assign first available IP from the subnet CIDR to the subnet namespace
-    next_ip = str(list(ipaddress.ip_network(cidr, strict=False).hosts())[0])
-    logger.info(f"Assigning IP {next_ip}/{sub_range} to veth-{name} in namespace {name}")
-    subprocess.run(["ip", "netns", "exec", name, "ip", "addr", "add", f"{next_ip}/{sub_range}", "dev", f"veth-{name}"], check=True)
+    tx.step(["ip", "netns", "exec", name, "ip", "addr", "add", f"{next_ip}/{sub_range}", "dev", f"veth-{name}"],
+            msg=f"Assigning IP {next_ip}/{sub_range} to veth-{name} in namespace {name}")
     
-    logger.info("Bringing up veth interface in namespace")
-    subprocess.run(["ip", "netns", "exec", name, "ip", "link", "set", f"veth-{name}", "up"], check=True)
-    subprocess.run(["ip", "netns", "exec", name, "ip", "link", "set", "lo", "up"], check=True)
+    tx.step(["ip", "netns", "exec", name, "ip", "link", "set", f"veth-{name}", "up"],
+            msg="Bringing up veth interface in namespace")
+    tx.step(["ip", "netns", "exec", name, "ip", "link", "set", "lo", "up"])
 
-    logger.info(f"Adding route to bridge gateway {bridge_gateway}")
-    subprocess.run(["ip", "netns", "exec", name, "ip", "route", "add", bridge_gateway, "dev", f"veth-{name}"], check=True)
+    tx.step(["ip", "netns", "exec", name, "ip", "route", "add", bridge_gateway, "dev", f"veth-{name}"],
+            msg=f"Adding route to bridge gateway {bridge_gateway}")
 
     # Set default route through the VPC bridge gateway
-    logger.info(f"Setting default route via {bridge_gateway}")
-    subprocess.run(["ip", "netns", "exec", name, "ip", "route", "add", "default", "via", bridge_gateway, "dev", f"veth-{name}"], check=True)
+    tx.step(["ip", "netns", "exec", name, "ip", "route", "add", "default", "via", bridge_gateway, "dev", f"veth-{name}"],
+            msg=f"Setting default route via {bridge_gateway}")
     
-    if type == "public":
-        logger.info(f"Configuring NAT for public subnet {name}")
-        # MASQUERADE only this specific public subnet
-        subprocess.run(["iptables", "-t", "nat", "-A", "POSTROUTING", "-s", cidr, "!", "-o", f"br-{vpc}", "-j", "MASQUERADE"], check=True)
-        
-        # Allow forwarding only for this specific public subnet
-        subprocess.run(["iptables", "-A", "FORWARD", "-s", cidr, "-j", "ACCEPT"], check=True)
+    subnet_network = str(ipaddress.ip_network(cidr, strict=False))
     
-        # Allow return traffic to this public subnet
-        subprocess.run(["iptables", "-A", "FORWARD", "-d", cidr, "-m", "state", "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"], check=True)
-        
-        logger.info(f"NAT gateway configured for subnet {name}")
+    if type == "public":
+        # MASQUERADE and forward only this specific public subnet
+        plan_set_member(tx, "vpcctl-public", subnet_network, msg=f"Configuring NAT for public subnet {name}")
+        plan_set_member(tx, "vpcctl-public-br", f"{subnet_network},br-{vpc}")
     else:
-        logger.info(f"Blocking outbound internet access for private subnet {name}")
         # Block private subnet from reaching the internet (anything not in VPC CIDR)
         vpc_cidr = get_bridge_cidr(f"br-{vpc}")
         vpc_network = str(ipaddress.ip_network(vpc_cidr, strict=False))
         
-        # Allow internal VPC traffic
-        subprocess.run(["iptables", "-A", "FORWARD", "-s", cidr, "-d", vpc_network, "-j", "ACCEPT"], check=True)
-        subprocess.run(["iptables", "-A", "FORWARD", "-d", cidr, "-s", vpc_network, "-j", "ACCEPT"], check=True)
-        
-        # Block everything else from this private subnet going out
-        subprocess.run(["iptables", "-A", "FORWARD", "-s", cidr, "!", "-d", vpc_network, "-j", "DROP"], check=True)
-        
+        plan_set_member(tx, "vpcctl-private", f"{subnet_network},{vpc_network}",
+                        msg=f"Blocking outbound internet access for private subnet {name}")
+        plan_set_member(tx, "vpcctl-isolated", subnet_network)
+
+    tx.apply(prepare=plan_dispatch_rules)
+
+    if type == "public":
+        logger.info(f"NAT gateway configured for subnet {name}")
+    else:
         logger.info(f"Private subnet {name} blocked from internet access")
     
     logger.info(f"Subnet '{name}' created successfully as {type} subnet")
@@ -176,57 +242,72 @@ def peer_vpcs(vpc_a, vpc_b):
     Peers two vpcs together
     """
     logger.info(f"Peering VPC '{vpc_a}' with VPC '{vpc_b}'")
-    
-    logger.info("Creating veth pair for VPC peering")
-    subprocess.run(["ip", "link", "add", f"veth-{vpc_a}", "type", "veth", "peer", "name", f"veth-{vpc_b}"], check=True)
-
-    logger.info("Attaching veth interfaces to respective bridges")
-    subprocess.run(["ip", "link", "set", f"veth-{vpc_a}", "master", f"br-{vpc_a}"], check=True)
-    subprocess.run(["ip", "link", "set", f"veth-{vpc_b}", "master", f"br-{vpc_b}"], check=True)
 
     vpc_a_cidr = str(ipaddress.ip_network(get_bridge_cidr(f"br-{vpc_a}"), strict=False))
     vpc_b_cidr = str(ipaddress.ip_network(get_bridge_cidr(f"br-{vpc_b}"), strict=False))
     logger.info(f"VPC '{vpc_a}' CIDR: {vpc_a_cidr}")
     logger.info(f"VPC '{vpc_b}' CIDR: {vpc_b_cidr}")
 
-    logger.info("Bringing up peering interfaces")
-    subprocess.run(["ip", "link", "set", f"veth-{vpc_a}", "up"], check=True)
-    subprocess.run(["ip", "link", "set", f"veth-{vpc_b}", "up"], check=True)
+    vpc_a_subs = get_subnets(vpc_a, silent=True)
+    vpc_b_subs = get_subnets(vpc_b, silent=True)
 
-    logger.info("Assigning IP addresses for peering")
-    subprocess.run(["ip", "addr", "add", "192.168.255.1/30", "dev", f"veth-{vpc_a}"], check=True)
-    subprocess.run(["ip", "addr", "add", "192.168.255.2/30", "dev", f"veth-{vpc_b}"], check=True)
+    tx = Transaction(f"peer-vpcs {vpc_a} {vpc_b}")
 
-    logger.info("Adding static routes between VPCs")
-    subprocess.run(["ip", "route", "replace", vpc_b_cidr, "via", "192.168.255.2", "dev", f"veth-{vpc_a}"], check=True)
-    subprocess.run(["ip", "route", "replace", vpc_a_cidr, "via", "192.168.255.1", "dev", f"veth-{vpc_b}"], check=True)
+    tx.step(["ip", "link", "add", f"veth-{vpc_a}", "type", "veth", "peer", "name", f"veth-{vpc_b}"],
+            undo=["ip", "link", "del", f"veth-{vpc_a}"],
+            msg="Creating veth pair for VPC peering")
 
-    logger.info("Updating iptables rules for peering")
-    subprocess.run(["iptables", "-D", "FORWARD", "-s", vpc_a_cidr, "-d", vpc_b_cidr, "-j" , "DROP"], check=False)
-    subprocess.run(["iptables", "-D", "FORWARD", "-s", vpc_b_cidr, "-d", vpc_a_cidr, "-j" , "DROP"], check=False)
-    subprocess.run(["iptables", "-A", "FORWARD", "-i", f"br-{vpc_a}", "-o", f"br-{vpc_b}", "-j", "ACCEPT"], check=False)
-    subprocess.run(["iptables", "-A", "FORWARD", "-i", f"br-{vpc_b}", "-o", f"br-{vpc_a}", "-j", "ACCEPT"], check=False)
+    tx.step(["ip", "link", "set", f"veth-{vpc_a}", "master", f"br-{vpc_a}"],
+            msg="Attaching veth interfaces to respective bridges")
+    tx.step(["ip", "link", "set", f"veth-{vpc_b}", "master", f"br-{vpc_b}"])
 
-    vpc_a_subs = get_subnets(vpc_a, silent=True)
-    vpc_b_subs = get_subnets(vpc_b, silent=True)
+    tx.step(["ip", "link", "set", f"veth-{vpc_a}", "up"], msg="Bringing up peering interfaces")
+    tx.step(["ip", "link", "set", f"veth-{vpc_b}", "up"])
 
-    vpc_a_gateway_cidr = get_bridge_cidr(f"br-{vpc_a}")
-    vpc_b_gateway_cidr = get_bridge_cidr(f"br-{vpc_b}")
+    tx.step(["ip", "addr", "add", "192.168.255.1/30", "dev", f"veth-{vpc_a}"],
+            msg="Assigning IP addresses for peering")
+    tx.step(["ip", "addr", "add", "192.168.255.2/30", "dev", f"veth-{vpc_b}"])
 
-    vpc_a_network = str(ipaddress.ip_network(vpc_a_gateway_cidr, strict=False).network_address) + "/" + str(ipaddress.ip_network(vpc_a_gateway_cidr, strict=False).prefixlen)
-    vpc_b_network = str(ipaddress.ip_network(vpc_b_gateway_cidr, strict=False).network_address) + "/" + str(ipaddress.ip_network(vpc_b_gateway_cidr, strict=False).prefixlen)
+    # "add" rather than "replace": an existing route to the peer fails the step
+    # up front instead of being deleted by the rollback
+    tx.step(["ip", "route", "add", vpc_b_cidr, "via", "192.168.255.2", "dev", f"veth-{vpc_a}"],
+            undo=["ip", "route", "del", vpc_b_cidr, "via", "192.168.255.2", "dev", f"veth-{vpc_a}"],
+            msg="Adding static routes between VPCs")
+    tx.step(["ip", "route", "add", vpc_a_cidr, "via", "192.168.255.1", "dev", f"veth-{vpc_b}"],
+            undo=["ip", "route", "del", vpc_a_cidr, "via", "192.168.255.1", "dev", f"veth-{vpc_b}"])
+
+    logger.info("Updating iptables rules for peering")
+    forward_rules = subprocess.run(["iptables", "-S", "FORWARD"], capture_output=True, text=True).stdout.splitlines()
+    deleted = []
+    for src_cidr, dst_cidr in ((vpc_a_cidr, vpc_b_cidr), (vpc_b_cidr, vpc_a_cidr)):
+        drop_rule = ["-s", src_cidr, "-d", dst_cidr, "-j", "DROP"]
+        # Only plan the delete (and its restore on rollback) when the rule is really there
+        spec = " ".join(["-A", "FORWARD", *drop_rule])
+        if spec not in forward_rules:
+            continue
+        # the first line of -S is the chain policy, so list index == rule number;
+        # rules already deleted above this one shift it up by one each
+        index = forward_rules.index(spec)
+        position = index - sum(1 for p in deleted if p < index)
+        deleted.append(index)
+        tx.step(["iptables", "-D", "FORWARD", *drop_rule],
+                undo=["iptables", "-I", "FORWARD", str(position), *drop_rule])
+    plan_set_member(tx, "vpcctl-peers", f"{vpc_a_cidr},{vpc_b_cidr}")
+    plan_set_member(tx, "vpcctl-peers", f"{vpc_b_cidr},{vpc_a_cidr}")
 
-    logger.info(f"Adding routes in VPC '{vpc_a}' subnets to reach VPC '{vpc_b}'")
     for sub in vpc_a_subs:
         sub_gateway = str(get_subnet_gateway_by_name(sub))
-        logger.info(f"Adding route in subnet '{sub}' via gateway {sub_gateway}")
-        subprocess.run(["ip", "netns", "exec", sub, "ip", "route", "add", vpc_b_network, "via", sub_gateway, "dev", f"veth-{sub}"], check=True)
+        tx.step(["ip", "netns", "exec", sub, "ip", "route", "add", vpc_b_cidr, "via", sub_gateway, "dev", f"veth-{sub}"],
+                undo=["ip", "netns", "exec", sub, "ip", "route", "del", vpc_b_cidr],
+                msg=f"Adding route in subnet '{sub}' via gateway {sub_gateway} to reach VPC '{vpc_b}'")
 
-    logger.info(f"Adding routes in VPC '{vpc_b}' subnets to reach VPC '{vpc_a}'")
     for sub in vpc_b_subs:
         sub_gateway = str(get_subnet_gateway_by_name(sub))
-        logger.info(f"Adding route in subnet '{sub}' via gateway {sub_gateway}")
-        subprocess.run(["ip", "netns", "exec", sub, "ip", "route", "add", vpc_a_network, "via", sub_gateway, "dev", f"veth-{sub}"], check=True)
+        tx.step(["ip", "netns", "exec", sub, "ip", "route", "add", vpc_a_cidr, "via", sub_gateway, "dev", f"veth-{sub}"],
+                undo=["ip", "netns", "exec", sub, "ip", "route", "del", vpc_a_cidr],
+                msg=f"Adding route in subnet '{sub}' via gateway {sub_gateway} to reach VPC '{vpc_a}'")
+
+    tx.apply(prepare=plan_dispatch_rules)
     
     logger.info(f"VPC peering between '{vpc_a}' and '{vpc_b}' completed successfully")
 
@@ -261,6 +342,110 @@ def deploy_workloads(name, port):
         check=True
     )
 
+CONN_RATE_RE = re.compile(r"^\d+/(second|minute|hour|day)$")
+# tc takes units in any case, e.g. 10Mbit or 1GBit
+TC_RATE_RE = re.compile(r"^\d+(\.\d+)?([kmg]?bit|[kmg]?bps)$", re.IGNORECASE)
+TC_SIZE_RE = re.compile(r"^\d+([kmg]?bit|[kmg]?b)?$", re.IGNORECASE)
+
+
+def _positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def validate_policy(policy):
+    """
+    Checks the fields that end up in the iptables-restore text or tc argv.
+    Numeric string ports ("80") are converted to int, as before policies
+    were validated. Raises ValueError describing the first bad field.
+    """
+    if "max_connections" in policy and not _positive_int(policy["max_connections"]):
+        raise ValueError(f"max_connections must be a positive integer, got {policy['max_connections']!r}")
+
+    for rule in policy.get("ingress", []):
+        if isinstance(rule.get("port"), str) and rule["port"].isdigit():
+            rule["port"] = int(rule["port"])
+        if not _positive_int(rule.get("port")) or rule["port"] > 65535:
+            raise ValueError(f"port must be an integer between 1 and 65535, got {rule.get('port')!r}")
+        if rule.get("protocol") not in ("tcp", "udp"):
+            raise ValueError(f"protocol must be tcp or udp, got {rule.get('protocol')!r}")
+        if rule.get("action") not in ("allow", "deny"):
+            raise ValueError(f"action must be allow or deny, got {rule.get('action')!r}")
+        if "conn_rate" in rule and not (isinstance(rule["conn_rate"], str) and CONN_RATE_RE.match(rule["conn_rate"])):
+            raise ValueError(f"conn_rate must look like '50/second', got {rule['conn_rate']!r}")
+        for field in ("conn_burst", "max_connections"):
+            if field in rule and not _positive_int(rule[field]):
+                raise ValueError(f"{field} must be a positive integer, got {rule[field]!r}")
+
+    rate_limit = policy.get("rate_limit", {})
+    for field, pattern in (("ingress", TC_RATE_RE), ("egress", TC_RATE_RE), ("burst", TC_SIZE_RE)):
+        if field in rate_limit and not (isinstance(rate_limit[field], str) and pattern.match(rate_limit[field])):
+            raise ValueError(f"rate_limit.{field} is not a valid tc value: {rate_limit[field]!r}")
+
+
+def compile_firewall(policy):
+    """
+    Compiles a firewall policy into an iptables-restore payload for the
+    subnet namespace, so the whole ruleset is loaded in one call
+    """
+    lines = ["*filter", ":INPUT DROP [0:0]", ":FORWARD ACCEPT [0:0]", ":OUTPUT ACCEPT [0:0]"]
+
+    # Loopback and replies are accepted before any cap, so traffic inside the
+    # namespace and existing connections never count against the limits
+    lines.append("-A INPUT -i lo -j ACCEPT")
+    lines.append("-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT")
+
+    # Cap on concurrent connections into the subnet as a whole
+    max_connections = policy.get("max_connections")
+    if max_connections:
+        lines.append(f"-A INPUT -m conntrack --ctstate NEW -m connlimit --connlimit-above {max_connections} "
+                     f"--connlimit-mask 0 -j REJECT")
+
+    for rule in policy.get("ingress", []):
+        port = str(rule["port"])
+        protocol = rule["protocol"]
+        action = "ACCEPT" if rule["action"] == "allow" else "DROP"
+        match = f"-A INPUT -p {protocol} --dport {port}"
+        logger.info(f"Adding rule: {action} {protocol} traffic on port {port}")
+
+        if rule.get("conn_rate"):
+            logger.info(f"Limiting new {protocol}/{port} connections to {rule['conn_rate']} per source")
+            lines.append(f"{match} -m conntrack --ctstate NEW -m hashlimit --hashlimit-above {rule['conn_rate']} "
+                         f"--hashlimit-burst {rule.get('conn_burst', 5)} --hashlimit-mode srcip "
+                         f"--hashlimit-name {protocol}{port} -j DROP")
+
+        if rule.get("max_connections"):
+            logger.info(f"Capping {protocol}/{port} at {rule['max_connections']} concurrent connections")
+            lines.append(f"{match} -m conntrack --ctstate NEW -m connlimit "
+                         f"--connlimit-above {rule['max_connections']} --connlimit-mask 0 -j REJECT")
+
+        lines.append(f"{match} -j {action}")
+
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def apply_rate_limit(namespace, rate_limit):
+    """
+    Shapes subnet traffic with tbf on both ends of its veth pair. Traffic
+    into the subnet leaves the bridge end, traffic out of it leaves the
+    namespace end. A missing direction removes any previous limit.
+    """
+    burst = rate_limit.get("burst", "32kbit")
+    devices = {
+        "ingress": ([], f"veth-{namespace}-br"),
+        "egress": (["ip", "netns", "exec", namespace], f"veth-{namespace}"),
+    }
+
+    for direction, (prefix, dev) in devices.items():
+        rate = rate_limit.get(direction)
+        if rate:
+            logger.info(f"Limiting {direction} of subnet '{namespace}' to {rate}")
+            subprocess.run([*prefix, "tc", "qdisc", "replace", "dev", dev, "root",
+                            "tbf", "rate", rate, "burst", burst, "latency", "50ms"], check=True)
+        else:
+            subprocess.run([*prefix, "tc", "qdisc", "del", "dev", dev, "root"], check=False, capture_output=True)
+
+
 @click.command()
 @click.argument("filename", required=True)
 def apply_firewall(filename):
@@ -272,7 +457,6 @@ def apply_firewall(filename):
     with open(filename, "r", encoding="utf-8") as f:
         policies = json.load(f)
 
-    namespace = ""
     policies = policies if isinstance(policies, list) else [policies]
     
     for policy in policies:
@@ -283,29 +467,36 @@ def apply_firewall(filename):
             logger.error(f"No namespace found for subnet {subnet_cidr}")
             continue
         
+        try:
+            validate_policy(policy)
+        except ValueError as e:
+            logger.error(f"Invalid policy for subnet {subnet_cidr}: {e}")
+            continue
+
         logger.info(f"Applying rules to subnet '{namespace}' ({subnet_cidr})")
-        logger.info("Flushing existing iptables rules")
-        subprocess.run(["ip", "netns", "exec", namespace, "iptables", "-F"], check=True)
-
-        for rule in policy.get("ingress", []):
-            port = str(rule["port"])
-            protocol = rule["protocol"]
-            action = "ACCEPT" if rule["action"] == "allow" else "DROP"
-            logger.info(f"Adding rule: {action} {protocol} traffic on port {port}")
-            subprocess.run([
-                "ip", "netns", "exec", namespace,
-                "iptables", "-A", "INPUT",
-                "-p", protocol,
-                "--dport", port,
-                "-j", action
-            ], check=True)
-
-    logger.info("Configuring default firewall policies")
-    subprocess.run(["ip", "netns", "exec", namespace, "iptables", "-A", "INPUT", "-m", "state", "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"], check=True)
-    subprocess.run(["ip", "netns", "exec", namespace, "iptables", "-A", "INPUT", "-i", "lo", "-j", "ACCEPT"], check=True)
-    subprocess.run(["ip", "netns", "exec", namespace, "iptables", "-P", "INPUT", "DROP"], check=True)
+        ruleset = compile_firewall(policy)
+
+        # iptables-restore replaces the filter table atomically, which also
+        # flushes the rules from any previous policy
+        subprocess.run(["ip", "netns", "exec", namespace, "iptables-restore"], input=ruleset, text=True, check=True)
+
+        apply_rate_limit(namespace, policy.get("rate_limit", {}))
+
     logger.info("Firewall rules applied successfully")
 
+def remove_set_members(keys):
+    """
+    Removes every dispatch ipset entry that mentions one of `keys`
+    (a subnet CIDR, VPC network or bridge name)
+    """
+    for set_name in DISPATCH_SETS:
+        result = subprocess.run(["ipset", "save", set_name], capture_output=True, text=True, check=False)
+        for line in result.stdout.splitlines():
+            parts = line.split()
+            if parts and parts[0] == "add" and keys & set(parts[2].split(",")):
+                subprocess.run(["ipset", "del", set_name, parts[2]], check=False)
+
+
 @click.command()
 @click.argument("name", required=True)
 def delete_vpc(name):
@@ -329,8 +520,14 @@ def delete_vpc(name):
     logger.info("Retrieving subnets attached to VPC")
     subnets = get_subnets(name, silent=True)
     
+    subnet_cidrs = set()
     for subnet in subnets:
         logger.info(f"Deleting subnet '{subnet}'")
+
+        try:
+            subnet_cidrs.add(get_subnet_cidr(subnet))
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logger.warning(f"Could not read CIDR of subnet '{subnet}': {e}")
         
         logger.info(f"Removing veth pair for subnet '{subnet}'")
         subprocess.run(["ip", "link", "del", f"veth-{subnet}-br"], check=False)
@@ -338,14 +535,12 @@ def delete_vpc(name):
         logger.info(f"Deleting network namespace '{subnet}'")
         subprocess.run(["ip", "netns", "del", subnet], check=False)
     
-    logger.info("Cleaning up iptables rules")
+    logger.info("Cleaning up firewall dispatch entries")
     try:
         vpc_cidr = get_bridge_cidr(bridge_name)
         subnet_network = str(ipaddress.ip_network(vpc_cidr, strict=False))
         
-        subprocess.run(["iptables", "-t", "nat", "-D", "POSTROUTING", "-s", subnet_network, "!", "-o", bridge_name, "-j", "MASQUERADE"], check=False)
-        subprocess.run(["iptables", "-D", "FORWARD", "-i", bridge_name, "-j", "ACCEPT"], check=False)
-        subprocess.run(["iptables", "-D", "FORWARD", "-o", bridge_name, "-j", "ACCEPT"], check=False)
+        remove_set_members({subnet_network, bridge_name, *subnet_cidrs})
     except Exception as e:
         logger.warning(f"Could not clean up iptables rules: {e}")
     